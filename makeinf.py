@@ -3,6 +3,7 @@
 from argparse import ArgumentParser
 from configparser import ConfigParser
 import os
+import re
 import shutil
 import pkgutil
 import tempfile
@@ -40,6 +41,177 @@ def load_data(package, subpackage, filename):
 def quoted_str(s):
     return '"{}"'.format(s.replace('%', '%%').replace('"', '""'))
 
+def glob_to_regex(pattern):
+    # Like fnmatch.translate, but '*' and '?' stop at '/' and '**' crosses
+    # directories. Returns a bare expression so it can be embedded in a
+    # bigger alternation.
+    res = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i+3] == '**/':
+                res.append('(?:.*/)?')
+                i += 3
+            elif pattern[i:i+2] == '**':
+                res.append('.*')
+                i += 2
+            else:
+                res.append('[^/]*')
+                i += 1
+        elif c == '?':
+            res.append('[^/]')
+            i += 1
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+                i += 1
+            else:
+                stuff = pattern[i+1:j]
+                negate = stuff[0] == '!'
+                if negate:
+                    stuff = stuff[1:]
+                stuff = ''.join('\\' + k if k in '\\[]^' else k for k in stuff)
+                # a bracket class must not match '/' either, not even via a range
+                if negate:
+                    res.append('[^/{}]'.format(stuff))
+                else:
+                    res.append('(?!/)[{}]'.format(stuff))
+                i = j + 1
+        else:
+            res.append(re.escape(c))
+            i += 1
+
+    return ''.join(res)
+
+class SourceFileFilter:
+    # Include/exclude rules for the source directory. Paths are matched
+    # relative to the source dir, starting with the DirId and using '/' as
+    # separator; directories get a trailing '/'. The last matching rule wins,
+    # paths matching no rule are included.
+    def __init__(self):
+        self.rules = []
+        self._matcher = None
+
+    @staticmethod
+    def _rule_regex(pattern):
+        if pattern.startswith('re:'):
+            return pattern[3:]
+
+        p = pattern.replace('\\', '/')
+        dironly = p.endswith('/')
+        p = p.rstrip('/')
+        anchored = '/' in p
+        rx = glob_to_regex(p.lstrip('/'))
+
+        if not anchored:
+            rx = '(?:.*/)?' + rx
+
+        if dironly:
+            rx += '/'
+        else:
+            rx += '/?'
+
+        return rx
+
+    @staticmethod
+    def _unsupported_regex_feature(rx):
+        # Every rule ends up wrapped in its own group inside one big
+        # alternation, which breaks numbered group references and lets
+        # inline flags leak into the other rules.
+        i = 0
+        n = len(rx)
+        in_class = False
+        while i < n:
+            c = rx[i]
+            if c == '\\':
+                if not in_class and i + 1 < n and rx[i+1] in '123456789':
+                    return 'numbered backreferences are not supported'
+                i += 2
+            elif in_class:
+                if c == ']':
+                    in_class = False
+                i += 1
+            elif c == '[':
+                in_class = True
+                i += 1
+                if i < n and rx[i] == '^':
+                    i += 1
+                if i < n and rx[i] == ']':
+                    i += 1
+            elif rx.startswith('(?(', i) and i + 3 < n and rx[i+3].isdigit():
+                return 'numbered group references are not supported'
+            elif re.match(r'\(\?[aiLmsux]+\)', rx[i:]):
+                return 'inline global flags are not supported'
+            else:
+                i += 1
+
+        return None
+
+    def add_rule(self, action, pattern):
+        if action not in ('include', 'exclude'):
+            raise Exception('Unknown rule action ‘{}’'.format(action))
+
+        rx = self._rule_regex(pattern)
+        problem = self._unsupported_regex_feature(rx)
+        if problem is not None:
+            raise Exception('Invalid rule pattern ‘{}’: {}'.format(pattern, problem))
+
+        # Compile the combined matcher right away, so clashes between rules
+        # are reported here and not halfway through copying the files.
+        rules = self.rules + [(action, rx)]
+        try:
+            matcher = self._compile(rules)
+        except re.error as e:
+            raise Exception('Invalid rule pattern ‘{}’: {}'.format(pattern, e))
+
+        self.rules = rules
+        self._matcher = matcher
+
+    def load_rules_file(self, filepath):
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if len(line) == 0 or line.startswith('#'):
+                    continue
+
+                parts = line.split(None, 1)
+                if len(parts) < 2:
+                    raise Exception('{}:{}: missing pattern'.format(filepath, lineno))
+
+                try:
+                    self.add_rule(parts[0], parts[1])
+                except Exception as e:
+                    raise Exception('{}:{}: {}'.format(filepath, lineno, e))
+
+    @staticmethod
+    def _compile(rules):
+        # All rules go into a single alternation, last rule first, so the
+        # first alternative that matches the whole path is the winning rule.
+        alternatives = []
+        for i in reversed(range(len(rules))):
+            alternatives.append('(?P<_rule{}>{})'.format(i, rules[i][1]))
+
+        return re.compile('|'.join(alternatives), re.IGNORECASE)
+
+    def is_excluded(self, relpath):
+        if self._matcher is None:
+            return False
+
+        m = self._matcher.fullmatch(relpath)
+        if m is None:
+            return False
+
+        return self.rules[int(m.lastgroup[5:])][0] == 'exclude'
+
 class FileTargetDir:
     _groupcounter = 1
 
@@ -208,6 +380,7 @@ class InfFileBuilder:
         self.installbeginprompt = None
         self.installendprompt = None
         self.advanced_inf = False
+        self.source_filter = SourceFileFilter()
 
         self.cabfiles.synth_file(infname + '.INF')
         self.cabfiles.reserve_name(infname + '.EXE') # for potential bootstrapper
@@ -215,17 +388,29 @@ class InfFileBuilder:
         self.cabfiles.reserve_name('W95INF16.DLL') # ^
         self.cabfiles.reserve_name('W95INF32.DLL') # ^
 
-    def _process_source_files_recourse(self, dirid, subdir_list, sourcedir):
+    def _is_excluded(self, relpath):
+        # Checked before stat'ing the entry: if both the file and the
+        # directory form are excluded, we don't need to know what it is.
+        # Returns (excluded_as_file, excluded_as_dir).
+        return (self.source_filter.is_excluded(relpath),
+                self.source_filter.is_excluded(relpath + '/'))
+
+    def _process_source_files_recourse(self, dirid, subdir_list, sourcedir, relpath):
         t = FileTargetDir(dirid, '\\'.join(subdir_list))
 
         for i in os.listdir(sourcedir):
             path = os.path.join(sourcedir, i)
-            if os.path.isfile(path):
+            irelpath = relpath + '/' + i
+            file_excluded, dir_excluded = self._is_excluded(irelpath)
+            if file_excluded and dir_excluded:
+                continue
+
+            if not file_excluded and os.path.isfile(path):
                 cabname = self.cabfiles.copy_file(path)
                 t.add_file(i, cabname)
 
-            if os.path.isdir(path):
-                for k in self._process_source_files_recourse(dirid, subdir_list + [i], path):
+            if not dir_excluded and os.path.isdir(path):
+                for k in self._process_source_files_recourse(dirid, subdir_list + [i], path, irelpath):
                     yield k
 
         if t.has_files():
@@ -234,13 +419,16 @@ class InfFileBuilder:
     def _process_source_files(self, source_dir):
         for i in os.listdir(source_dir):
             path = os.path.join(source_dir, i)
+            if self.source_filter.is_excluded(i + '/'):
+                continue
+
             if not os.path.isdir(path):
                 raise Exception('‘{}’ is not a directory'.format(path))
 
             dirid = int(i)
             subdir_list = []
 
-            for k in self._process_source_files_recourse(dirid, subdir_list, path):
+            for k in self._process_source_files_recourse(dirid, subdir_list, path, i):
                 yield k
 
     def add_source_files(self, sourcedir):
@@ -569,6 +757,12 @@ def initialize_inf_builder(outdir, args):
     if args.advanced_inf:
         b.advanced_inf = args.advanced_inf
 
+    for action, value in args.source_rules or []:
+        if action == 'rules-file':
+            b.source_filter.load_rules_file(value)
+        else:
+            b.source_filter.add_rule(action, value)
+
     b.installbeginprompt = 'Do you want to install {}?'.format(b.title or b.infname)
     b.installendprompt = '{} has been installed successfully.'.format(b.title or b.infname)
 
@@ -591,6 +785,9 @@ ap.add_argument('--with-bootstrapper', default=False, action='store_true')
 ap.add_argument('--advanced-inf', default=False, action='store_true')
 ap.add_argument('--iexpress-binary', metavar='IEXPRESS.EXE', default='IEXPRESS.EXE')
 ap.add_argument('--no-cab-compress', action='store_true', default=False)
+ap.add_argument('--include', metavar='PATTERN', dest='source_rules', action='append', type=lambda p: ('include', p))
+ap.add_argument('--exclude', metavar='PATTERN', dest='source_rules', action='append', type=lambda p: ('exclude', p))
+ap.add_argument('--rules-file', metavar='FILE', dest='source_rules', action='append', type=lambda p: ('rules-file', p))
 
 args = ap.parse_args()
 